@@ -0,0 +1,76 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+C kernel for npa.simplify_operator_ids.
+Build it in place with "cythonize -i _npa_fast.pyx"; npa.py uses it when
+the compiled module is importable and the pure-Python kernel otherwise.
+"""
+from libc.stdint cimport int16_t
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+
+cdef int simplify_ints(const int16_t* buf, int n, const int16_t* party, int num_parties,
+                       int16_t* stacks, int* tops, int16_t* out) noexcept nogil:
+    """
+    Pushes each operator onto its party's stack (or cancels the top), then
+    concatenates the stacks into 'out' in canonical party order.
+    'stacks' holds num_parties rows of length n. Returns the output length.
+    """
+    cdef int k, p, t, x
+    cdef int out_len = 0
+    for p in range(num_parties):
+        tops[p] = 0
+    for k in range(n):
+        x = buf[k]
+        p = party[x]
+        t = tops[p]
+        if t > 0 and stacks[p * n + t - 1] == x:
+            tops[p] = t - 1
+        else:
+            stacks[p * n + t] = x
+            tops[p] = t + 1
+    for p in range(num_parties):
+        for k in range(tops[p]):
+            out[out_len] = stacks[p * n + k]
+            out_len += 1
+    return out_len
+
+
+def simplify(tuple product, tuple op_party, int num_parties):
+    """
+    Simplifies a tuple of operator ids; see npa.simplify_operator_ids.
+    Both 'product' and 'op_party' must be tuples. Raises IndexError for an
+    operator id outside op_party and ValueError for a party id outside
+    range(num_parties), since the kernel itself does no bounds checking.
+    """
+    cdef int n = len(product)
+    cdef int num_ops = len(op_party)
+    cdef int k, x, out_len
+    if n == 0:
+        return ()
+
+    cdef int16_t* buf = <int16_t*> PyMem_Malloc((2 * n + num_ops + num_parties * n) * sizeof(int16_t))
+    cdef int* tops = <int*> PyMem_Malloc(num_parties * sizeof(int))
+    if buf == NULL or tops == NULL:
+        PyMem_Free(buf)
+        PyMem_Free(tops)
+        raise MemoryError()
+    cdef int16_t* out = buf + n
+    cdef int16_t* party = buf + 2 * n
+    cdef int16_t* stacks = buf + 2 * n + num_ops
+    try:
+        for k in range(n):
+            x = product[k]
+            if x < 0 or x >= num_ops:
+                raise IndexError(f"operator id {x} out of range")
+            buf[k] = x
+        for k in range(num_ops):
+            x = op_party[k]
+            if x < 0 or x >= num_parties:
+                raise ValueError(f"party id {x} out of range")
+            party[k] = x
+        with nogil:
+            out_len = simplify_ints(buf, n, party, num_parties, stacks, tops, out)
+        return tuple([out[k] for k in range(out_len)])
+    finally:
+        PyMem_Free(buf)
+        PyMem_Free(tops)
@@ -1,133 +1,371 @@
 import re
-from itertools import product
 
-def simplify_product_advanced(product_str):
+# Backends: simplify_operator_ids runs the compiled _npa_fast kernel when it has
+# been built and pure Python otherwise. The Numba moment-matrix fill is opt-in
+# (use_numba=True), since its JIT compile outweighs the gain on small matrices.
+try:
+    import numpy as np
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Build the C kernel explicitly with "cythonize -i _npa_fast.pyx".
+try:
+    from _npa_fast import simplify as _simplify_fast
+except ImportError:
+    _simplify_fast = None
+
+
+def encode_operators(base_operators):
     """
-    Simplifies an operator product string with correct commutation rules.
+    Assigns each base operator an integer party id.
+    Operator ids are positions in 'base_operators'; party ids follow the
+    canonical party order (A then B), so sorting by party id is canonical.
+    Returns the per-operator party ids and the number of parties.
+    """
+    parties = sorted({op[0] for op in base_operators})
+    party_id = {party: k for k, party in enumerate(parties)}
+    op_party = tuple(party_id[op[0]] for op in base_operators)
+    return op_party, len(parties)
+
+
+def decode_product(product, base_operators):
+    """Converts a tuple of operator ids back into its product string."""
+    if not product:
+        return "Id"
+    if len(product) == 1:
+        return base_operators[product[0]]
+    return " ".join([base_operators[x] for x in product])
+
+
+def simplify_operator_ids(product, op_party, num_parties):
+    """
+    Simplifies an operator product given as a tuple of operator ids.
     - Operators from different parties (A, B) commute.
     - Operators from the same party (A1, A2) DO NOT commute.
+    The identity is the empty tuple. Any sequences are accepted; the result
+    is always a tuple.
     """
-    operators = [op for op in product_str.split() if op != "Id"]
-    if not operators:
-        return "Id"
+    if _simplify_fast is not None:
+        return _simplify_fast(tuple(product), tuple(op_party), num_parties)
 
     # 1. Group operators by party, maintaining original relative order.
-    party_groups = {}
-    for op in operators:
-        party = op[0]
-        if party not in party_groups:
-            party_groups[party] = []
-        party_groups[party].append(op)
-    
-    # 2. For each party, simplify adjacent O^2=I pairs iteratively.
-    for party, op_list in party_groups.items():
-        simplified = True
-        while simplified:
-            simplified = False
-            if len(op_list) < 2:
-                break
-            next_op_list = []
-            i = 0
-            while i < len(op_list):
-                if i + 1 < len(op_list) and op_list[i] == op_list[i+1]:
-                    i += 2
-                    simplified = True
-                else:
-                    next_op_list.append(op_list[i])
-                    i += 1
-            op_list = next_op_list
-        party_groups[party] = op_list
-
-    # 3. Recombine party groups in canonical order (A then B).
+    groups = [[] for _ in range(num_parties)]
+    for x in product:
+        groups[op_party[x]].append(x)
+
+    # 2. For each party, cancel adjacent O^2=I pairs in a single stack pass,
+    #    then recombine the groups in canonical order (A then B).
     final_ops = []
-    for party in sorted(party_groups.keys()):
-        final_ops.extend(party_groups[party])
+    for op_list in groups:
+        stack = []
+        for x in op_list:
+            if stack and stack[-1] == x:
+                stack.pop()
+            else:
+                stack.append(x)
+        final_ops.extend(stack)
 
-    if not final_ops:
-        return "Id"
-    return " ".join(final_ops)
+    return tuple(final_ops)
 
 
-def generate_level_n_set(base_operators, level):
-    """Generates the full operator set up to a given integer level 'n'."""
-    identity = "Id"
+def dagger_operator_ids(product, op_party):
+    """
+    Returns the adjoint of an already simplified operator-id product.
+    Since every operator is Hermitian, the adjoint reverses the order within
+    each party; the canonical party order (A then B) is kept.
+    """
+    final_ops = []
+    start = 0
+    for k in range(1, len(product) + 1):
+        if k == len(product) or op_party[product[k]] != op_party[product[start]]:
+            final_ops.extend(reversed(product[start:k]))
+            start = k
+    return tuple(final_ops)
+
+
+if njit is not None:
+    @njit(cache=True)
+    def simplify_ints(buf, length, party_of, num_parties, stacks, tops, out):
+        """
+        nopython counterpart of simplify_operator_ids on an int16 buffer.
+        Each operator is pushed onto its party's stack (or cancels the top),
+        then the stacks are concatenated into 'out' in canonical party order.
+        Returns the length of the simplified product written to 'out'.
+        """
+        tops[:] = 0
+        for k in range(length):
+            x = buf[k]
+            p = party_of[x]
+            t = tops[p]
+            if t > 0 and stacks[p, t - 1] == x:
+                tops[p] = t - 1
+            else:
+                stacks[p, t] = x
+                tops[p] = t + 1
+
+        out_len = 0
+        for p in range(num_parties):
+            for k in range(tops[p]):
+                out[out_len] = stacks[p, k]
+                out_len += 1
+        return out_len
+
+    @njit(parallel=True, cache=True)
+    def simplify_upper_triangle_keys(products, lengths, party_of, num_parties, base):
+        """
+        Simplifies op_i^dagger * op_j for every j >= i of a padded basis array.
+        Each result is packed into one int64 key, sum_k (id_k + 1) * base**k,
+        so the cells can be deduplicated as a flat integer array. Returns an
+        (n, n) int64 array; only the upper triangle is filled.
+        """
+        n, width = products.shape
+        max_len = 2 * width
+        out = np.zeros((n, n), np.int64)
+        for i in prange(n):
+            buf = np.empty(max_len, np.int16)
+            cell = np.empty(max_len, np.int16)
+            stacks = np.empty((num_parties, max_len), np.int16)
+            tops = np.empty(num_parties, np.int64)
+            len_i = lengths[i]
+            for k in range(len_i):
+                buf[k] = products[i, len_i - 1 - k]
+            for j in range(i, n):
+                len_j = lengths[j]
+                for k in range(len_j):
+                    buf[len_i + k] = products[j, k]
+                cell_len = simplify_ints(buf, len_i + len_j, party_of, num_parties, stacks, tops, cell)
+                key = 0
+                for k in range(cell_len - 1, -1, -1):
+                    key = key * base + cell[k] + 1
+                out[i, j] = key
+        return out
+
+
+def simplify_product_advanced(product_str):
+    """
+    Simplifies an operator product string with correct commutation rules.
+    - Operators from different parties (A, B) commute.
+    - Operators from the same party (A1, A2) DO NOT commute.
+    """
+    operators = [op for op in product_str.split() if op != "Id"]
+    op_names = sorted(set(operators))
+    op_id = {op: k for k, op in enumerate(op_names)}
+    op_party, num_parties = encode_operators(op_names)
+
+    product = tuple(op_id[op] for op in operators)
+    simplified = simplify_operator_ids(product, op_party, num_parties)
+    return decode_product(simplified, op_names)
+
+
+def _level_n_ids(base_operators, level):
+    """
+    Generates the full operator set up to a given integer level 'n'.
+    Products are returned as tuples of indices into 'base_operators'.
+    """
+    op_party, num_parties = encode_operators(base_operators)
+    identity = ()
     if level == 0:
         return {identity}
 
+    base_ids = [(x,) for x in range(len(base_operators))]
     operator_set = {identity}
-    operator_set.update(base_operators)
+    operator_set.update(base_ids)
     
-    current_level_products = set(base_operators)
+    # Only products first reached at the previous level need extending: anything
+    # seen earlier has already been multiplied by every base operator.
+    frontier = set(base_ids)
     for _ in range(1, level):
-        next_level_products = set()
-        for op1 in current_level_products:
-            for op2 in base_operators:
-                product_str = f"{op1} {op2}"
-                simplified = simplify_product_advanced(product_str)
-                next_level_products.add(simplified)
-        operator_set.update(next_level_products)
-        current_level_products = next_level_products
+        new_frontier = set()
+        for op1 in frontier:
+            for op2 in base_ids:
+                simplified = simplify_operator_ids(op1 + op2, op_party, num_parties)
+                if simplified not in operator_set:
+                    operator_set.add(simplified)
+                    new_frontier.add(simplified)
+        frontier = new_frontier
         
     return operator_set
 
-def generate_string_term_set(base_operators_by_party, term_str):
-    """Generates the operator set for a specific string term like 'AB' or 'AAB'."""
+def _string_term_ids(base_operators, term_str):
+    """
+    Generates the operator set for a specific string term like 'AB' or 'AAB'.
+    Products are returned as tuples of indices into 'base_operators'.
+    """
+    op_party, num_parties = encode_operators(base_operators)
+
+    base_ids_by_party = {}
+    for x, op in enumerate(base_operators):
+        party = op[0]
+        if party not in base_ids_by_party:
+            base_ids_by_party[party] = []
+        base_ids_by_party[party].append(x)
+
     operator_pools = []
     for party_char in term_str:
-        if party_char in base_operators_by_party:
-            operator_pools.append(base_operators_by_party[party_char])
+        if party_char in base_ids_by_party:
+            operator_pools.append(base_ids_by_party[party_char])
         else:
             return set()
-            
+
+    # Walk the combinations depth-first, pushing each operator onto its
+    # party's stack (or cancelling the top), so every prefix is reduced once
+    # and shared by all combinations extending it.
     term_set = set()
-    for combo in product(*operator_pools):
-        product_str = " ".join(combo)
-        simplified = simplify_product_advanced(product_str)
-        term_set.add(simplified)
-        
+    stacks = [[] for _ in range(num_parties)]
+    depth_count = len(operator_pools)
+
+    def extend(depth):
+        if depth == depth_count:
+            final_ops = []
+            for stack in stacks:
+                final_ops.extend(stack)
+            term_set.add(tuple(final_ops))
+            return
+        for x in operator_pools[depth]:
+            stack = stacks[op_party[x]]
+            if stack and stack[-1] == x:
+                stack.pop()
+                extend(depth + 1)
+                stack.append(x)
+            else:
+                stack.append(x)
+                extend(depth + 1)
+                stack.pop()
+
+    extend(0)
     return term_set
 
-def npa_hierarchy_intermediate(base_operators, level_str):
+def generate_level_n_set(base_operators, level):
+    """Generates the full operator set up to a given integer level 'n'."""
+    return {decode_product(p, base_operators) for p in _level_n_ids(base_operators, level)}
+
+def generate_string_term_set(base_operators_by_party, term_str):
+    """Generates the operator set for a specific string term like 'AB' or 'AAB'."""
+    base_operators = [op for ops in base_operators_by_party.values() for op in ops]
+    return {decode_product(p, base_operators) for p in _string_term_ids(base_operators, term_str)}
+
+def _fill_moment_matrix_numba(moment_matrix_symbolic, sorted_products, base_operators, op_party, num_parties):
+    """
+    Fills the symbolic moment matrix using the JIT-compiled kernel.
+    Only distinct simplified products are converted back to strings.
+    Returns the (name, adjoint name) pair of every distinct upper-triangle entry.
+    """
+    n = len(sorted_products)
+    width = max(1, max(len(p) for p in sorted_products))
+    base = len(base_operators) + 1
+    if base ** (2 * width) >= 2 ** 63:
+        # Products too long to pack into an int64 key.
+        return _fill_moment_matrix_python(moment_matrix_symbolic, sorted_products, base_operators, op_party, num_parties)
+
+    products = np.full((n, width), -1, np.int16)
+    lengths = np.zeros(n, np.int64)
+    for i, p in enumerate(sorted_products):
+        products[i, :len(p)] = p
+        lengths[i] = len(p)
+
+    out = simplify_upper_triangle_keys(products, lengths, np.array(op_party, np.int64), num_parties, base)
+
+    rows, cols = np.triu_indices(n)
+    unique_keys, inverse = np.unique(out[rows, cols], return_inverse=True)
+
+    entry_names = []
+    for key in unique_keys.tolist():
+        simplified = []
+        while key:
+            key, digit = divmod(key, base)
+            simplified.append(digit - 1)
+        simplified = tuple(simplified)
+        simplified_dag = dagger_operator_ids(simplified, op_party)
+        entry_names.append((decode_product(simplified, base_operators),
+                            decode_product(simplified_dag, base_operators)))
+
+    for i, j, k in zip(rows.tolist(), cols.tolist(), inverse.reshape(-1).tolist()):
+        names = entry_names[k]
+        moment_matrix_symbolic[i][j] = names[0]
+        moment_matrix_symbolic[j][i] = names[1]
+
+    return entry_names
+
+
+def _fill_moment_matrix_python(moment_matrix_symbolic, sorted_products, base_operators, op_party, num_parties):
+    """
+    Fills the symbolic moment matrix with the cached pure-Python kernel.
+    Returns the (name, adjoint name) pair of every distinct upper-triangle entry.
+    """
+    n = len(sorted_products)
+
+    # Row i needs the dagger of its basis element (reversed order).
+    op_dag_parts = [p[::-1] for p in sorted_products]
+
+    # Each simplified product maps to its (name, adjoint name) pair once.
+    entry_names = {}
+
+    for i in range(n):
+        op_i_dag_parts = op_dag_parts[i]
+        row_i = moment_matrix_symbolic[i]
+        # Gamma is Hermitian: build the upper triangle and mirror its adjoint.
+        for j in range(i, n):
+            simplified = simplify_operator_ids(op_i_dag_parts + sorted_products[j], op_party, num_parties)
+            names = entry_names.get(simplified)
+            if names is None:
+                simplified_dag = dagger_operator_ids(simplified, op_party)
+                names = (decode_product(simplified, base_operators),
+                         decode_product(simplified_dag, base_operators))
+                entry_names[simplified] = names
+            row_i[j] = names[0]
+            moment_matrix_symbolic[j][i] = names[1]
+
+    return list(entry_names.values())
+
+
+def npa_hierarchy_intermediate(base_operators, level_str, use_numba=False, return_monomials=False):
     """
     Generates and returns the symbolic structure of the NPA hierarchy.
+    Returns the sorted basis and the symbolic moment matrix. With
+    return_monomials=True, the sorted list of distinct monomials appearing in
+    the matrix is returned as a third value, so the solver need not rescan it.
+    With use_numba=True the moment matrix is filled by the JIT-compiled kernel,
+    which pays off on large, repeatedly built matrices.
     """
+    if use_numba and njit is None:
+        raise ImportError("use_numba=True requires numba")
+    op_party, num_parties = encode_operators(base_operators)
     final_operator_set = set()
 
-    base_operators_by_party = {}
-    for op in base_operators:
-        party = op[0]
-        if party not in base_operators_by_party:
-            base_operators_by_party[party] = []
-        base_operators_by_party[party].append(op)
-
     terms = [term.strip() for term in level_str.split('+')]
     
     for term in terms:
         if term.isdigit():
             level = int(term)
-            level_set = generate_level_n_set(base_operators, level)
+            level_set = _level_n_ids(base_operators, level)
             final_operator_set.update(level_set)
         else:
-            term_set = generate_string_term_set(base_operators_by_party, term)
-            final_operator_set.add("Id")
+            term_set = _string_term_ids(base_operators, term)
+            final_operator_set.add(())
             final_operator_set.update(term_set)
 
-    sorted_operator_set = sorted(list(final_operator_set), key=lambda s: (s.count(' ') + (1 if s != "Id" else 0), s))
+    # Sort by (length, name) with the keys precomputed once per element; names
+    # are unique, so the products themselves are never compared.
+    items = [(len(p), decode_product(p, base_operators), p) for p in final_operator_set]
+    items.sort()
+    sorted_operator_set = [s for _, s, _ in items]
+    sorted_products = [p for _, _, p in items]
     
     n = len(sorted_operator_set)
     moment_matrix_symbolic = [["" for _ in range(n)] for _ in range(n)]
 
-    for i in range(n):
-        for j in range(n):
-            op_i_str = sorted_operator_set[i]
-            op_j_str = sorted_operator_set[j]
-            
-            op_i_dag_parts = list(reversed(op_i_str.split()))
-            op_j_parts = op_j_str.split()
-
-            full_product_str = " ".join(op_i_dag_parts + op_j_parts)
-            
-            simplified = simplify_product_advanced(full_product_str)
-            moment_matrix_symbolic[i][j] = simplified
-    
-    return sorted_operator_set, moment_matrix_symbolic
+    if use_numba:
+        fill_moment_matrix = _fill_moment_matrix_numba
+    else:
+        fill_moment_matrix = _fill_moment_matrix_python
+    entry_names = fill_moment_matrix(moment_matrix_symbolic, sorted_products, base_operators, op_party, num_parties)
+
+    if not return_monomials:
+        return sorted_operator_set, moment_matrix_symbolic
+
+    # Collect the distinct monomials here so the solver need not rescan the matrix.
+    monomial_set = set()
+    for names in entry_names:
+        monomial_set.update(names)
+    return sorted_operator_set, moment_matrix_symbolic, sorted(monomial_set)
@@ -1,5 +1,6 @@
 import numpy as np
 import cvxpy as cp
+import scipy.sparse as sp
 
 # Import the blueprint generator from the npa.py file you provided
 from npa import npa_hierarchy_intermediate
@@ -76,10 +77,69 @@ def parse_bell_functional_sympy(functional_str, base_operators):
             
     return objective_coeffs
 
-def solve_npa_from_symbolic(symbolic_basis, symbolic_matrix, objective_coeffs):
+def build_dual_problem(selectors, identity_cells, cost, is_complex, offset=0.0):
     """
-    Builds and solves a dimension-independent Semidefinite Program (SDP) 
-    from the symbolic NPA matrix structure.
+    Builds the Lagrange dual of the NPA moment SDP.
+
+    The primal maximizes cost @ y subject to the Hermitian part of
+    F0 + sum_k y_k S_k being PSD, where S_k are the monomial selectors and F0
+    holds the identity cells. Its dual is
+        minimize Re tr(F0 Z)  s.t.  Re tr(S_k Z) = -cost_k,  Z >> 0,
+    plus Im tr(S_k Z) = 0 for every complex-valued monomial.
+
+    Args:
+        selectors (scipy.sparse matrix): (n*n) x K selector matrix; row i*n+j marks
+                                         which monomial sits in cell (i, j).
+        identity_cells (np.ndarray): Length n*n 0/1 vector of the identity cells.
+        cost (np.ndarray or cp.Parameter): Length K objective coefficients of the monomials
+                                           (unused when K is 0).
+        is_complex (np.ndarray): Length K boolean mask of complex-valued monomials.
+        offset (float or cp.Parameter): Constant added to the objective (the identity coefficient).
+
+    Returns:
+        cp.Problem: The dual problem; its optimal value equals the primal bound.
+    """
+    n = int(round(np.sqrt(len(identity_cells))))
+    if is_complex.any():
+        Z = cp.Variable((n, n), hermitian=True)
+    else:
+        Z = cp.Variable((n, n), symmetric=True)
+
+    # Entry i*n+j of the flattened transpose is Z[j, i], so selectors.T @ z_t
+    # yields tr(S_k Z) for every monomial k at once.
+    z_t = cp.reshape(Z.T, (n * n,), order='C')
+    identity_trace = identity_cells @ z_t
+    constraints = [Z >> 0]
+    if selectors.shape[1]:
+        traces = selectors.T @ z_t
+        complex_idx = np.flatnonzero(is_complex)
+        if len(complex_idx):
+            constraints += [cp.real(traces) == -cost, cp.imag(traces[complex_idx]) == 0]
+            identity_trace = cp.real(identity_trace)
+        else:
+            constraints.append(traces == -cost)
+
+    objective = cp.Minimize(identity_trace + offset)
+    return cp.Problem(objective, constraints)
+
+def build_cost_vector(objective_coeffs, var_index, num_columns):
+    """
+    Gathers the Bell functional's coefficients into one entry per variable column.
+
+    Coefficients of monomials absent from the moment matrix are ignored, and the
+    identity coefficient is left to the objective's offset.
+    """
+    cost = np.zeros(num_columns)
+    for op, coeff in objective_coeffs.items():
+        if op in var_index:
+            cost[var_index[op]] += coeff
+    return cost
+
+def build_npa_problem(symbolic_basis, symbolic_matrix, dual=False, complex_moments=False,
+                      unique_monomials=None, objective_coeffs=None):
+    """
+    Builds the dimension-independent Semidefinite Program (SDP) from the
+    symbolic NPA matrix structure.
 
     This function takes the abstract "blueprint" of the moment matrix and
     translates it into a concrete optimization problem that CVXPY can solve.
@@ -89,66 +149,231 @@ def solve_npa_from_symbolic(symbolic_basis, symbolic_matrix, objective_coeffs):
                                and columns of the moment matrix (e.g., ['Id', 'A1', 'A1 B1']).
         symbolic_matrix (list of lists): The 2D list where each entry is a string 
                                          representing the simplified operator product.
-        objective_coeffs (dict): A dictionary mapping monomial strings to their 
-                                 coefficients in the Bell inequality to be maximized.
+        dual (bool): If True, build the explicitly dualized SDP instead of the primal.
+                     This is often smaller for SCS but can be slower on some scenarios.
+        complex_moments (bool): If True, model moments as complex variables (real only where
+                                physically guaranteed). The default real representation
+                                halves the variable count and is exact for real functionals.
+        unique_monomials (list): The sorted distinct entries of symbolic_matrix, as returned by
+                                 npa_hierarchy_intermediate. Rescanned from the matrix if omitted.
+        objective_coeffs (dict): The Bell functional to maximize, built into the objective as
+                                 constants. If omitted, the objective is left as parameters.
 
     Returns:
-        float: The optimal value found by the SDP solver, representing the upper bound
-               on the Bell inequality's quantum value.
+        tuple: (problem, cost, offset, var_index). 'cost' holds one objective coefficient
+               per variable column, 'offset' the identity coefficient, and 'var_index' maps
+               each non-identity monomial string to its column in 'cost'. Without
+               objective_coeffs, 'cost' and 'offset' are cp.Parameters to be set before
+               solving, and 'cost' is None when there are no variables (as at level 0).
     """
     n = len(symbolic_basis)
     
     # --- Step 1: Identify all unique monomials and create a CVXPY variable for each ---
-    # Scan the entire symbolic matrix blueprint to find every unique operator product
-    # (monomial) that appears as an entry.
-    unique_monomials = sorted(list(set(item for row in symbolic_matrix for item in row)))
-    # Create a dictionary where each unique monomial string is a key, and its value
-    # is a CVXPY variable. By default, these represent complex-valued moments <S>.
-    monomial_vars = {mon: cp.Variable(complex=True) for mon in unique_monomials}
-    
-    # --- Step 2: Enforce reality conditions based on physical principles ---
-    # Certain expectation values are guaranteed to be real numbers. We must
-    # enforce this in the SDP for correctness.
-    real_valued_keys = {"Id"}
-    # Single operator expectation values like <A1> or <B2> are real.
-    for op in symbolic_basis:
-        if " " not in op: real_valued_keys.add(op)
-    # Correlation terms between parties like <A1 B1> are also real.
-    for op1 in symbolic_basis:
-        if op1.startswith('A'):
-            for op2 in symbolic_basis:
-                if op2.startswith('B'):
-                    # The key must match the canonical form from npa.py's simplify function
-                    real_valued_keys.add(" ".join(sorted([op1, op2])))
+    # The blueprint is converted once to a fixed-width string array, and every cell is
+    # mapped to the index of its monomial (operator product) in unique_monomials, in C.
+    # npa.py supplies the sorted monomials; they are found with np.unique otherwise.
+    cell_array = np.array(symbolic_matrix)
+    if unique_monomials is None:
+        monomial_array, idx_matrix = np.unique(cell_array, return_inverse=True)
+        unique_monomials = monomial_array.tolist()
+        idx_matrix = idx_matrix.reshape(n, n)
+    else:
+        idx_matrix = np.searchsorted(np.array(unique_monomials), cell_array)
+    if complex_moments:
+        # Opt-in complex model: each unique monomial string maps to its own CVXPY
+        # variable, which starts out as a complex-valued moment <S>.
+        monomial_vars = {mon: cp.Variable(complex=True) for mon in unique_monomials}
+        
+        # --- Step 2: Enforce reality conditions based on physical principles ---
+        # Certain expectation values are guaranteed to be real numbers. We must
+        # enforce this in the SDP for correctness.
+        real_valued_keys = {"Id"}
+        # Single operator expectation values like <A1> or <B2> are real. The basis is
+        # scanned once for them and they are reused for the correlators below.
+        single_ops = [op for op in symbolic_basis if " " not in op and op != "Id"]
+        real_valued_keys.update(single_ops)
+        # Correlation terms between parties like <A1 B1> are also real.
+        a_ops = [op for op in single_ops if op.startswith('A')]
+        b_ops = [op for op in single_ops if op.startswith('B')]
+        for op1 in a_ops:
+            for op2 in b_ops:
+                # Already canonical (A then B), matching npa.py's simplify function
+                real_valued_keys.add(f"{op1} {op2}")
     
-    # Re-declare the variables for real-valued moments without the complex=True flag.
-    for key in real_valued_keys:
-        if key in monomial_vars:
-            monomial_vars[key] = cp.Variable()
+        # Re-declare the variables for real-valued moments without the complex=True flag.
+        for key in real_valued_keys:
+            if key in monomial_vars:
+                monomial_vars[key] = cp.Variable()
+    else:
+        # For a Bell functional with real coefficients, the real part of any feasible
+        # moment matrix is feasible with the same value, so every moment can be taken
+        # real. Then <S> = <S^dagger>: each monomial shares one real variable with its
+        # adjoint, which is the entry in the mirrored cell of the blueprint.
+        rows, cols = np.triu_indices(n)
+        adjoint_pairs = np.unique(np.stack([idx_matrix[rows, cols], idx_matrix[cols, rows]], axis=1), axis=0)
+        monomial_vars = {}
+        for k, k_dag in adjoint_pairs.tolist():
+            mon = unique_monomials[k]
+            if mon not in monomial_vars:
+                monomial_vars[mon] = monomial_vars[unique_monomials[k_dag]] = cp.Variable()
 
+    # --- Step 3: Build the moment matrix Gamma as a CVXPY expression ---
     # The expectation value of the identity operator is always 1, not a variable.
-    monomial_vars['Id'] = 1.0
+    # Gamma = sum_k var_k * S_k, where S_k is the sparse 0/1 selector of the cells
+    # holding monomial k. The selectors are stacked as the columns of one sparse
+    # (n*n) x K matrix, so Gamma is a single affine expression instead of n^2
+    # scalar nodes, which keeps CVXPY's canonicalization cost low.
+    # Monomials sharing a variable (a real moment and its adjoint) share a column.
+    moment_variables = []
+    var_index = {}
+    column_of_var = {}
+    for mon in unique_monomials:
+        if mon == 'Id':
+            continue
+        var = monomial_vars[mon]
+        if var.id not in column_of_var:
+            column_of_var[var.id] = len(moment_variables)
+            moment_variables.append(var)
+        var_index[mon] = column_of_var[var.id]
+    # Cell i*n+j takes the column of its monomial; -1 marks the identity cells.
+    monomial_columns = np.array([var_index.get(mon, -1) for mon in unique_monomials])
+    cell_columns = monomial_columns[idx_matrix.ravel()]
+    is_variable = cell_columns >= 0
+    identity_cells = (~is_variable).astype(float)
+    selectors = sp.csr_matrix((np.ones(np.count_nonzero(is_variable)),
+                               (np.flatnonzero(is_variable), cell_columns[is_variable])),
+                              shape=(n * n, len(moment_variables)))
+    if moment_variables:
+        moment_vector = cp.hstack(moment_variables)
+    else:
+        # Level 0: every cell is the identity, so Gamma is a constant matrix.
+        moment_vector = None
 
-    # --- Step 3: Build the moment matrix Gamma as a CVXPY expression ---
-    # This programmatically assembles the individual monomial variables into the full
-    # moment matrix variable according to the symbolic blueprint.
-    gamma = cp.bmat([[monomial_vars[symbolic_matrix[i][j]] for j in range(n)] for i in range(n)])
+    def template(cells):
+        """Affine expression for the given flattened cells of Gamma."""
+        if moment_vector is None:
+            return cp.Constant(identity_cells[cells])
+        return selectors[cells] @ moment_vector + identity_cells[cells]
 
     # --- Step 4: Define the objective function to be maximized ---
-    # The objective is the Bell inequality, constructed as a linear combination of the
-    # monomial variables using the provided coefficients.
-    objective = cp.sum([coeff * monomial_vars[op] for op, coeff in objective_coeffs.items() if op in monomial_vars])
+    # The objective is the Bell inequality, a linear combination of the monomial
+    # variables plus the identity coefficient as an offset. Left as parameters, the
+    # compiled problem can be re-solved for other functionals, but CVXPY's first
+    # compile of a parametrized problem is several times slower, so the coefficients
+    # are built in as constants whenever they are known up front.
+    if objective_coeffs is None:
+        offset = cp.Parameter()
+        if moment_vector is None:
+            cost = None
+            objective = offset
+        else:
+            cost = cp.Parameter(len(moment_variables))
+            objective = cost @ moment_vector + offset
+    else:
+        # Only the functional's own terms enter the objective; a dense cost row over
+        # every moment dominates the compile time of large problems.
+        offset = cp.Constant(objective_coeffs.get('Id', 0.0))
+        cost = build_cost_vector(objective_coeffs, var_index, len(moment_variables))
+        terms = np.flatnonzero(cost)
+        objective = offset
+        if len(terms):
+            objective = cost[terms] @ cp.hstack([moment_variables[k] for k in terms]) + offset
     
-    # --- Step 5: Define the core NPA constraint ---
+    # --- Step 5: Define the core NPA constraint and assemble the problem ---
     # The single most important constraint is that the moment matrix must be
     # positive semidefinite. This is the mathematical condition for a set of
     # correlations to be compatible with quantum mechanics.
-    constraints = [gamma >> 0]
-    
-    # --- Step 6: Solve the optimization problem ---
-    problem = cp.Problem(cp.Maximize(cp.real(objective)), constraints)
+    if dual:
+        # The dual places this cone on its own multiplier Z (see build_dual_problem),
+        # so the primal constraint is not built at all.
+        is_complex = np.array([var.is_complex() for var in moment_variables])
+        problem = build_dual_problem(selectors, identity_cells, cost, is_complex, offset)
+    else:
+        if complex_moments:
+            # Gamma itself need not be Hermitian here; its Hermitian part must be PSD.
+            # The cone is placed on a Hermitian variable G tied to that part on the upper
+            # triangle only, which compiles much faster than symmetrizing the n x n
+            # affine expression of complex scalars.
+            rows, cols = np.triu_indices(n)
+            upper, lower = rows * n + cols, cols * n + rows
+            upper_entries = template(upper)
+            lower_entries = template(lower)
+            G = cp.Variable((n, n), hermitian=True)
+            constraints = [G >> 0, G[rows, cols] == (upper_entries + cp.conj(lower_entries)) / 2]
+        else:
+            # Real moments are shared with their adjoints, so Gamma is symmetric and the
+            # affine expression goes into the PSD cone directly, with no extra variables.
+            gamma = cp.reshape(template(slice(None)), (n, n), order='C')
+            constraints = [gamma >> 0]
+        if objective.is_complex():
+            objective = cp.real(objective)
+        problem = cp.Problem(cp.Maximize(objective), constraints)
+    return problem, cost, offset, var_index
+
+# Parametrized problems built for reuse_problem=True, keyed by (basis, matrix, dual,
+# complex_moments) and ordered from least to most recently used. Each one holds a
+# compiled problem, so only the last PROBLEM_CACHE_SIZE are kept.
+PROBLEM_CACHE_SIZE = 8
+_problem_cache = {}
+
+def clear_problem_cache():
+    """Drops every problem cached by solve_npa_from_symbolic(..., reuse_problem=True)."""
+    _problem_cache.clear()
+
+def solve_npa_from_symbolic(symbolic_basis, symbolic_matrix, objective_coeffs, dual=False, complex_moments=False,
+                            unique_monomials=None, reuse_problem=False):
+    """
+    Builds and solves a dimension-independent Semidefinite Program (SDP) 
+    from the symbolic NPA matrix structure.
+
+    Args:
+        symbolic_basis (list): The list of unique monomial strings that label the rows 
+                               and columns of the moment matrix (e.g., ['Id', 'A1', 'A1 B1']).
+        symbolic_matrix (list of lists): The 2D list where each entry is a string 
+                                         representing the simplified operator product.
+        objective_coeffs (dict): A dictionary mapping monomial strings to their 
+                                 coefficients in the Bell inequality to be maximized.
+        dual (bool): If True, solve the explicitly dualized SDP instead of the primal.
+                     This is often smaller for SCS but can be slower on some scenarios.
+        complex_moments (bool): If True, model moments as complex variables (real only where
+                                physically guaranteed). The default real representation
+                                halves the variable count and is exact for real functionals.
+        unique_monomials (list): The sorted distinct entries of symbolic_matrix, as returned by
+                                 npa_hierarchy_intermediate. Rescanned from the matrix if omitted.
+        reuse_problem (bool): If True, build the problem with a parametrized objective and cache
+                              it, so later calls on the same blueprint only update the parameters
+                              and re-solve (see clear_problem_cache). The first solve is slower,
+                              so this only pays off when several functionals are solved on one
+                              basis.
+
+    Returns:
+        float: The optimal value found by the SDP solver, representing the upper bound
+               on the Bell inequality's quantum value.
+    """
+    if reuse_problem:
+        key = (tuple(symbolic_basis), tuple(map(tuple, symbolic_matrix)), dual, complex_moments)
+        cached = _problem_cache.pop(key, None)
+        if cached is None:
+            cached = build_npa_problem(symbolic_basis, symbolic_matrix, dual=dual,
+                                       complex_moments=complex_moments,
+                                       unique_monomials=unique_monomials)
+        _problem_cache[key] = cached
+        while len(_problem_cache) > PROBLEM_CACHE_SIZE:
+            del _problem_cache[next(iter(_problem_cache))]
+        problem, cost, offset, var_index = cached
+        if cost is not None:
+            cost.value = build_cost_vector(objective_coeffs, var_index, cost.shape[0])
+        offset.value = objective_coeffs.get('Id', 0.0)
+    else:
+        problem = build_npa_problem(symbolic_basis, symbolic_matrix, dual=dual,
+                                    complex_moments=complex_moments,
+                                    unique_monomials=unique_monomials,
+                                    objective_coeffs=objective_coeffs)[0]
+
     # The problem is passed to an external solver (SCS is a good default).
-    problem.solve(solver=cp.SCS, verbose=True)
+    # Warm starting would begin from the previous functional's optimum, which is
+    # typically far from the new one, so each solve starts cold.
+    problem.solve(solver=cp.SCS, warm_start=False, verbose=True)
 
     print("\n--- Solver Results ---")
     if problem.status in ["infeasible", "unbounded"]:
@@ -183,13 +408,15 @@ if __name__ == '__main__':
     # --- Main Execution ---
     # 1. Get the symbolic structure (blueprint) from the npa.py library.
     try:
-        basis, sym_matrix = npa_hierarchy_intermediate(base_operators, level_to_solve)
+        basis, sym_matrix, unique_monomials = npa_hierarchy_intermediate(base_operators, level_to_solve,
+                                                                         return_monomials=True)
         print(f"Generated symbolic structure for level '{level_to_solve}'. Matrix size: {len(basis)}x{len(basis)}.")
     except Exception as e:
         print(f"\nError from npa.py: {e}"); exit()
         
     # 2. Call the main solver function with the blueprint and the objective.
-    max_bound = solve_npa_from_symbolic(basis, sym_matrix, objective_coeffs)
+    max_bound = solve_npa_from_symbolic(basis, sym_matrix, objective_coeffs,
+                                        unique_monomials=unique_monomials)
 
     # 3. Display the final result and compare it to the known theoretical value.
     tsirelson_bound = 2 * np.sqrt(2)